@@ -7,30 +7,61 @@ algorithm flag.
       --project_id=my-project-id \
       --registry_id=example-my-registry-id \
       --device_id=my-device-id \
-      --private_key_file=rsa_private.pem \
-      --algorithm=RS256
+      --private_key_file=ec_private.pem \
+      --algorithm=ES256
+
+ES256 is the default as ECDSA signing is much cheaper than RSA; RS256 is
+still supported for devices registered with RSA keys.
 
 With a single server, you can run multiple instances of the device with
 different device ids, and the server will distinguish them. Try creating a few
 devices and running them all at the same time.
+
+A single process can also simulate several devices by repeating --device_id.
+With --gateway_id the devices are attached to that gateway and share its
+MQTT connection instead of opening one connection each.
 """
 
 import argparse
-import datetime
+import functools
 import json
 import logging
 import os
 import random
 import ssl
+import threading
 import time
 
 from dataclasses import dataclass
-from contextlib import contextmanager
-from random import randint
+from contextlib import ExitStack, contextmanager
+from typing import Callable, List, Union
 
-import jwt
 import paho.mqtt.client as mqtt
 
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+try:
+    # orjson parses JSON considerably faster than the standard library.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    # Rust-backed drop-in replacement for PyJWT with the same encode API.
+    import jwt_rs as jwt
+    # jwt_rs is only known to sign with PEM encoded keys.
+    _JWT_PEM_KEYS = True
+except ImportError:
+    import jwt
+    _JWT_PEM_KEYS = False
+
+try:
+    # Native RS256 signer calling OpenSSL directly, bypasses PyJWT.
+    from jwtsign import PyJwtEncoder
+except ImportError:
+    PyJwtEncoder = None
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(module)s - %(message)s",
@@ -39,22 +70,132 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Lifetime of a JWT issued by `create_jwt`, in seconds.
+JWT_EXPIRATION = 60 * 60
+# A cached JWT is renewed this long before it actually expires, in seconds.
+JWT_RENEWAL_MARGIN = 60
+
+# OpenSSL cipher list used for TLS 1.2 connections to the MQTT bridge.
+TLS_CIPHERS = "ECDHE+AESGCM:ECDHE+CHACHA20"
 
-def create_jwt(project_id, private_key_file, algorithm):
+# (project_id, algorithm, private_key_file) -> (token, expiration time)
+_jwt_cache = {}
+
+# Command line arguments parser, see `parse_command_line_args`.
+_PARSER = None
+
+
+@functools.lru_cache()
+def load_signing_key(private_key_file, algorithm):
+    """
+    Loads and parses a PEM private key used to sign JWTs.
+
+    The key is cached, so the file is read only once per process. For RS256
+    a native `jwtsign` encoder is returned instead of a key object when that
+    package is installed, with `jwt_rs` the raw PEM bytes are returned.
+    """
+    logger.debug("Loading '%s' private key from file '%s'",
+                 algorithm, private_key_file)
+    with open(private_key_file, "rb") as f:
+        private_key = f.read()
+    if PyJwtEncoder is not None and algorithm == "RS256":
+        return PyJwtEncoder(private_key)
+    if _JWT_PEM_KEYS:
+        return private_key
+    return serialization.load_pem_private_key(
+        private_key,
+        password=None,
+        backend=default_backend()
+    )
+
+
+def create_jwt(project_id, signing_key, algorithm):
     """
     Creates a JWT to establish an MQTT connection.
+
+    :param signing_key: private key object, PEM bytes or `jwtsign` encoder
+        (see `load_signing_key`).
     """
 
+    now = int(time.time())
     token = {
-        "iat": datetime.datetime.utcnow(),
-        "exp": datetime.datetime.utcnow() + datetime.timedelta(minutes=60),
+        "iat": now,
+        "exp": now + JWT_EXPIRATION,
         "aud": project_id
     }
-    with open(private_key_file, "r") as f:
-        private_key = f.read()
-    logger.debug(f"Creating JWT using '{algorithm}' "
-                 f"from private key file '{private_key_file}'")
-    return jwt.encode(token, private_key, algorithm=algorithm)
+    logger.debug("Creating JWT using '%s'", algorithm)
+    if PyJwtEncoder is not None and isinstance(signing_key, PyJwtEncoder):
+        return signing_key.encode_claims_json_obj(token)
+    return jwt.encode(token, signing_key, algorithm=algorithm)
+
+
+def get_jwt(project_id, private_key_file, algorithm):
+    """
+    Returns a JWT for the project, reusing a cached one while it is valid.
+
+    A new JWT is only signed when the cached one is about to expire
+    (see `JWT_RENEWAL_MARGIN`).
+    """
+    key = (project_id, algorithm, private_key_file)
+    now = time.time()
+    cached = _jwt_cache.get(key)
+    if cached and now + JWT_RENEWAL_MARGIN < cached[1]:
+        return cached[0]
+
+    signing_key = load_signing_key(private_key_file, algorithm)
+    token = create_jwt(project_id, signing_key, algorithm)
+    _jwt_cache[key] = (token, now + JWT_EXPIRATION)
+    return token
+
+
+class SessionResumingSSLContext(ssl.SSLContext):
+    """
+    SSL context that resumes the last saved TLS session on new connections.
+    """
+
+    # TLS session to resume, `None` forces a full handshake.
+    session = None
+
+    def wrap_socket(self, *args, **kwargs):
+        if self.session is not None:
+            kwargs.setdefault("session", self.session)
+        return super().wrap_socket(*args, **kwargs)
+
+
+def make_client_id(project_id, cloud_region, registry_id, device_id):
+    """
+    Builds the MQTT client ID of a Cloud IoT device.
+    """
+    return (
+        f"projects/{project_id}/"
+        f"locations/{cloud_region}/"
+        f"registries/{registry_id}/"
+        f"devices/{device_id}"
+    )
+
+
+def wait_for_publish(message_infos, timeout):
+    """
+    Waits for queued messages to be published.
+
+    Gives up once no message got published for `timeout` seconds, e.g.
+    because the connection is lost, instead of blocking forever like
+    paho's `MQTTMessageInfo.wait_for_publish`.
+
+    :param message_infos: list of paho `MQTTMessageInfo`.
+    :param timeout: time to wait for the next message, in seconds.
+    :return: number of messages that are still not published.
+    """
+    deadline = time.monotonic() + timeout
+    for i, message_info in enumerate(message_infos):
+        while not message_info.is_published():
+            if time.monotonic() >= deadline:
+                return sum(
+                    not info.is_published() for info in message_infos[i:]
+                )
+            time.sleep(0.01)
+        deadline = time.monotonic() + timeout
+    return 0
 
 
 def error_str(rc):
@@ -64,50 +205,34 @@ def error_str(rc):
     return f"{rc}: {mqtt.error_string(rc)}"
 
 
-class Device:
+class BaseDevice:
     """
-    Represents the state of a single device.
+    Represents the identity (IDs and MQTT topics) of a single device.
     """
 
-    # The maximum backoff time before giving up, in seconds.
-    MAX_BACKOFF_TIME = 32
-
     def __init__(self, project_id, cloud_region, registry_id, device_id):
         # params that form client_id
         self._project_id = project_id
         self._cloud_region = cloud_region
         self._registry_id = registry_id
         self._device_id = device_id
+        self._client_id = make_client_id(
+            project_id,
+            cloud_region,
+            registry_id,
+            device_id
+        )
 
-        self._client = mqtt.Client(client_id=self.client_id)
-
-        self._client.on_connect = self.on_connect
-        self._client.on_publish = self.on_publish
-        self._client.on_disconnect = self.on_disconnect
-        self._client.on_subscribe = self.on_subscribe
-        self._client.on_message = self.on_message
-        # Whether to wait with exponential backoff before publishing.
-        self._should_backoff = True
-        # The initial backoff time after a disconnection occurs, in seconds.
-        self._min_backoff_time = 1
-
-    @classmethod
-    def create_from_client_id(cls, client_id):
-        """
-        Creates a Device from client_id string.
-
-        :param client_id: client_id as a string.
-        """
-        return cls(*client_id.split("/")[1::2])
+        # MQTT topics of the device, they never change so build them once.
+        self._telemetry_topic = f"/devices/{device_id}/events"
+        self._config_topic = f"/devices/{device_id}/config"
+        self._commands_topic = f"/devices/{device_id}/commands/#"
+        self._state_topic = f"/devices/{device_id}/state"
+        self._errors_topic = f"/devices/{device_id}/errors"
 
     @property
     def client_id(self):
-        return (
-            f"projects/{self._project_id}/"
-            f"locations/{self._cloud_region}/"
-            f"registries/{self._registry_id}/"
-            f"devices/{self._device_id}"
-        )
+        return self._client_id
 
     @property
     def project_id(self):
@@ -125,39 +250,168 @@ class Device:
     def device_id(self):
         return self._device_id
 
+    @property
+    def telemetry_topic(self):
+        """
+        Topic the device publishes telemetry events
+        (e.g. temperature data, power consumption etc.) to.
+        """
+        return self._telemetry_topic
+
+    @property
+    def config_topic(self):
+        """
+        Topic the device receives configuration updates on.
+        """
+        return self._config_topic
+
+    @property
+    def commands_topic(self):
+        """
+        Topic the device receives commands from IoT Core on.
+        """
+        return self._commands_topic
+
+    @property
+    def state_topic(self):
+        """
+        Topic the device sends state updates on.
+        """
+        return self._state_topic
+
+    @property
+    def errors_topic(self):
+        """
+        Topic a gateway receives errors from IoT Core on, e.g. rejected
+        attaches or publishes of its attached devices.
+        """
+        return self._errors_topic
+
+
+class Device(BaseDevice):
+    """
+    Represents the state of a single device.
+    """
+
+    # The maximum backoff time before giving up, in seconds.
+    MAX_BACKOFF_TIME = 32
+
+    def __init__(self, project_id, cloud_region, registry_id, device_id):
+        super().__init__(project_id, cloud_region, registry_id, device_id)
+
+        self._client = mqtt.Client(client_id=self.client_id)
+
+        self._client.on_connect = self.on_connect
+        self._client.on_publish = self.on_publish
+        self._client.on_disconnect = self.on_disconnect
+        self._client.on_subscribe = self.on_subscribe
+        self._client.on_message = self.on_message
+        # Whether to wait with exponential backoff before connecting, the
+        # first connect is attempted right away.
+        self._should_backoff = False
+        # The initial backoff time after a disconnection occurs, in seconds.
+        self._min_backoff_time = 1
+        # Callable returning a fresh JWT, used to renew it on reconnects.
+        self._token_factory = None
+        # Set while the device is connected to the MQTT bridge.
+        self._connected_event = threading.Event()
+        # Topics the device receives configs on, see `add_config_topic`.
+        self._config_topics = {self.config_topic}
+        # config topic -> last config successfully parsed from it
+        self._last_configs = {}
+        # TLS context of the connection, see `tls_set`.
+        self._ssl_context = None
+
+    @classmethod
+    def create_from_client_id(cls, client_id):
+        """
+        Creates a Device from client_id string.
+
+        :param client_id: client_id as a string.
+        """
+        return cls(*client_id.split("/")[1::2])
+
     def authenticate(self, token):
+        """
+        Sets the JWT used as the MQTT password.
+
+        :param token: JWT string or a callable returning one. A callable is
+            called again on every disconnect, so the client reconnects with
+            a valid (possibly renewed) token.
+        """
+        if callable(token):
+            self._token_factory = token
+            token = token()
         self._client.username_pw_set(username="unused", password=token)
 
-    def tls_set(self, ca_certs, tls_version, **kwargs):
-        self._client.tls_set(
-            ca_certs=ca_certs,
-            tls_version=tls_version,
-            **kwargs
-        )
+    def tls_set(self, ca_certs, tls_version, certfile=None, keyfile=None,
+                cert_reqs=None, ciphers=None):
+        """
+        Configures TLS for the MQTT connection.
+
+        Takes the same arguments as paho's `Client.tls_set`. The TLS session
+        of every successful connection is kept and resumed on reconnect,
+        which avoids a full handshake.
+        """
+        context = SessionResumingSSLContext(tls_version)
+        if cert_reqs is None:
+            cert_reqs = ssl.CERT_REQUIRED
+        # check_hostname has to be turned off before verification can be.
+        context.check_hostname = cert_reqs != ssl.CERT_NONE
+        context.verify_mode = cert_reqs
+        # Session tickets are needed to resume TLS 1.3 sessions.
+        context.options &= ~ssl.OP_NO_TICKET
+        if tls_version == ssl.PROTOCOL_TLS_CLIENT:
+            # Negotiate TLS 1.3 where possible, never anything below 1.2.
+            context.minimum_version = ssl.TLSVersion.TLSv1_2
+        # Only AEAD ciphers with forward secrecy for TLS 1.2 by default,
+        # AES-GCM is hardware accelerated on most CPUs (TLS 1.3 suites are
+        # all AEAD).
+        context.set_ciphers(ciphers or TLS_CIPHERS)
+        if ca_certs:
+            context.load_verify_locations(cafile=ca_certs)
+        else:
+            context.load_default_certs()
+        if certfile:
+            context.load_cert_chain(certfile, keyfile)
+        self._ssl_context = context
+        self._client.tls_set_context(context)
 
     def connect(self, mqtt_bridge_hostname, mqtt_bridge_port):
-        logger.info(f"Connecting... {mqtt_bridge_hostname}:{mqtt_bridge_port}")
+        logger.info("Connecting... %s:%s",
+                    mqtt_bridge_hostname, mqtt_bridge_port)
         if self._should_backoff:
             # If backoff time is too large, give up.
             if self._min_backoff_time > self.MAX_BACKOFF_TIME:
                 logger.error(
-                    f"Exceeded maximum backoff time for the device with "
-                    f"ID '{self.device_id}'. Giving up."
+                    "Exceeded maximum backoff time for the device with "
+                    "ID '%s'. Giving up.",
+                    self.device_id
                 )
                 return
-            delay = self._min_backoff_time + random.randint(0, 1000) / 1000.0
+            delay = self._min_backoff_time + random.random()
             time.sleep(delay)
             self._min_backoff_time *= 2
-            self._client.connect(
-                host=mqtt_bridge_hostname,
-                port=mqtt_bridge_port
-            )
+        self._client.connect(
+            host=mqtt_bridge_hostname,
+            port=mqtt_bridge_port
+        )
+
+    def wait_for_connection(self, timeout):
+        """
+        Blocks until the device is connected to the MQTT bridge.
+
+        :param timeout: time to wait for the connection, in seconds.
+        :raises RuntimeError: if the device is not connected in time.
+        """
+        if not self._connected_event.wait(timeout):
+            raise RuntimeError("Could not connect to MQTT bridge.")
 
     def disconnect(self):
         self._client.disconnect()
 
     def publish(self, topic, payload=None, qos=0, retain=False, properties=None): # noqa
-        self._client.publish(
+        return self._client.publish(
             topic,
             payload=payload,
             qos=qos,
@@ -165,6 +419,34 @@ class Device:
             properties=properties
         )
 
+    def publish_many(self, topic, payloads, qos=0, retain=False):
+        """
+        Publishes several messages to the same topic.
+
+        This is a convenience over calling `publish` for every payload, it
+        does no batching: paho still queues and sends each message on its
+        own. Use `wait_for_publish` on the result before disconnecting.
+
+        :param payloads: iterable of message payloads.
+        :return: list of paho `MQTTMessageInfo`, one per message.
+        """
+        publish = self._client.publish
+        return [
+            publish(topic, payload=payload, qos=qos, retain=retain)
+            for payload in payloads
+        ]
+
+    def add_config_topic(self, topic):
+        """
+        Handles messages on the topic as configs, e.g. the config topic of
+        a device attached to this gateway.
+        """
+        self._config_topics.add(topic)
+
+    def remove_config_topic(self, topic):
+        self._config_topics.discard(topic)
+        self._last_configs.pop(topic, None)
+
     def subscribe(self, topic, qos=0, options=None, properties=None):
         self._client.subscribe(
             topic,
@@ -183,22 +465,36 @@ class Device:
         """
         Callback for when a device connects.
         """
-        logger.info(f"on_connect {mqtt.connack_string(rc)}")
+        logger.info("on_connect %s", mqtt.connack_string(rc))
+        if rc != mqtt.CONNACK_ACCEPTED:
+            return
 
         # After a successful connect, reset backoff time and stop backing off.
         self._should_backoff = False
         self._min_backoff_time = 1
+        self._connected_event.set()
+
+        # Keep the TLS session, so it is resumed on reconnect.
+        sock = self._client.socket()
+        if self._ssl_context and isinstance(sock, ssl.SSLSocket):
+            logger.debug("TLS session reused: %s", sock.session_reused)
+            self._ssl_context.session = sock.session
 
     def on_disconnect(self, unused_client, unused_userdata, rc):
         """
         Callback for when a device disconnects.
         """
-        logger.info(f"Disconnected: {error_str(rc)}")
+        logger.info("Disconnected: %s", error_str(rc))
+        self._connected_event.clear()
 
         # Since a disconnect occurred, the next loop iteration will wait with
         # exponential backoff.
         self._should_backoff = True
 
+        # Make sure the reconnect is not attempted with an expired JWT.
+        if self._token_factory:
+            self.authenticate(self._token_factory)
+
     def on_publish(self, unused_client, unused_userdata, unused_mid):
         """
         Callback when the device receives a PUBACK from the MQTT bridge.
@@ -209,7 +505,7 @@ class Device:
         """
         Callback when the device receives a SUBACK from the MQTT bridge.
         """
-        logger.info(f"Subscribed: {granted_qos}")
+        logger.info("Subscribed: %s", granted_qos)
         if granted_qos[0] == 128:
             logger.info("Subscription failed.")
 
@@ -217,11 +513,16 @@ class Device:
         """
         Callback when the device receives a message on a subscription.
         """
-        payload = message.payload.decode("utf-8")
-        logger.info(
-            f"Received message '{payload}' on topic '{message.topic}' "
-            f"with Qos {str(message.qos)}."
-        )
+        payload = message.payload
+        if message.topic == self.errors_topic:
+            logger.error("IoT Core error: %s", payload.decode("utf-8"))
+            return
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Received message '%s' on topic '%s' with Qos %d.",
+                payload.decode("utf-8"), message.topic, message.qos
+            )
 
         # The device will receive its latest config when it subscribes to the
         # config topic. If there is no configuration for the device, the device
@@ -230,14 +531,137 @@ class Device:
             logger.info("No payload provided.")
             return
 
+        # IoT Core re-sends the config frequently, don't parse it again if it
+        # is the same as the last one received on this topic. Commands are
+        # events, so repeated ones are always handled.
+        is_config = message.topic in self._config_topics
+        if is_config and self._last_configs.get(message.topic) == payload:
+            logger.debug("Config unchanged.")
+            return
+
         # The config is passed in the payload of the message.
-        data = json.loads(payload)
-        logger.info(f"Received payload: {data}")
+        data = json_loads(payload)
+        if is_config:
+            self._last_configs[message.topic] = payload
+        logger.info("Received payload: %s", data)
 
 
-def parse_command_line_args():
+class FleetDevice(BaseDevice):
     """
-    Parse command line arguments.
+    Represents a device attached to a gateway.
+
+    It has no MQTT connection of its own and publishes/subscribes through
+    the gateway's one.
+    """
+
+    def __init__(self, gateway, device_id):
+        super().__init__(
+            gateway.project_id,
+            gateway.cloud_region,
+            gateway.registry_id,
+            device_id
+        )
+        self._gateway = gateway
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None): # noqa
+        return self._gateway.publish(
+            topic,
+            payload=payload,
+            qos=qos,
+            retain=retain,
+            properties=properties
+        )
+
+    def publish_many(self, topic, payloads, qos=0, retain=False):
+        return self._gateway.publish_many(
+            topic,
+            payloads,
+            qos=qos,
+            retain=retain
+        )
+
+    def subscribe(self, topic, qos=0, options=None, properties=None):
+        self._gateway.subscribe(
+            topic,
+            qos=qos,
+            options=options,
+            properties=properties
+        )
+
+
+class DeviceFleet:
+    """
+    Simulates several devices over a single gateway MQTT connection.
+
+    All devices share the gateway's MQTT client, TLS session, JWT and network
+    loop thread. The devices must be bound to the gateway in IoT Core and the
+    gateway must use association only authentication.
+    """
+
+    def __init__(self, gateway):
+        self._gateway = gateway
+        self._devices = {}
+
+    @property
+    def gateway(self):
+        return self._gateway
+
+    @property
+    def devices(self):
+        return list(self._devices.values())
+
+    def attach(self, device_id):
+        """
+        Attaches a device to the gateway.
+
+        :param device_id: ID of a device bound to the gateway.
+        :return: attached device.
+        """
+        device = FleetDevice(self._gateway, device_id)
+        self._gateway.add_config_topic(device.config_topic)
+        self._gateway.publish(
+            f"/devices/{device_id}/attach",
+            json.dumps({"authorization": ""}),
+            qos=1
+        )
+        self._devices[device_id] = device
+        return device
+
+    def detach(self, device_id):
+        """
+        Detaches a previously attached device from the gateway.
+
+        :param device_id: ID of an attached device.
+        :return: paho `MQTTMessageInfo` of the detach message.
+        """
+        device = self._devices.pop(device_id)
+        self._gateway.remove_config_topic(device.config_topic)
+        return self._gateway.publish(f"/devices/{device_id}/detach", qos=1)
+
+
+def non_negative_float(value):
+    """
+    Converts a command line argument to a float that is not negative.
+    """
+    number = float(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"'{value}' must not be negative")
+    return number
+
+
+def positive_float(value):
+    """
+    Converts a command line argument to a float that is greater than zero.
+    """
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"'{value}' must be positive")
+    return number
+
+
+def create_parser():
+    """
+    Create command line arguments parser.
     """
     parser = argparse.ArgumentParser(
         description="Fake Google Cloud IoT MQTT device."
@@ -255,8 +679,15 @@ def parse_command_line_args():
     )
     parser.add_argument(
         "--device_id",
+        action="append",
         required=True,
-        help="Cloud IoT device id"
+        help="Cloud IoT device id. Can be repeated to simulate several "
+             "devices in one process."
+    )
+    parser.add_argument(
+        "--gateway_id",
+        help="Cloud IoT gateway id. If set, devices are attached to the "
+             "gateway and share its MQTT connection."
     )
     parser.add_argument(
         "--private_key_file",
@@ -266,8 +697,8 @@ def parse_command_line_args():
     parser.add_argument(
         "--algorithm",
         choices=("RS256", "ES256"),
-        default="RS256",
-        help="Encryption algorithm to generate the JWT. Defaults to RS256."
+        default="ES256",
+        help="Encryption algorithm to generate the JWT. Defaults to ES256."
     )
     parser.add_argument(
         "--cloud_region",
@@ -284,6 +715,13 @@ def parse_command_line_args():
         type=int,
         default=20,
         help="Number of messages to publish.")
+    parser.add_argument(
+        "--publish_interval",
+        type=non_negative_float,
+        default=4,
+        help="Maximum random delay between messages, in seconds. "
+             "Use 0 to publish messages as fast as possible."
+    )
     parser.add_argument(
         "--mqtt_bridge_hostname",
         default="mqtt.googleapis.com",
@@ -295,27 +733,45 @@ def parse_command_line_args():
         default=8883,
         help="MQTT bridge port."
     )
+    parser.add_argument(
+        "--connect_timeout",
+        type=positive_float,
+        default=5,
+        help="Time to wait for the MQTT bridge connection, in seconds."
+    )
     parser.add_argument(
         "-v", "--verbose",
         action="store_true",
         help="increase output verbosity"
     )
-    return parser.parse_args()
+    return parser
+
+
+def parse_command_line_args():
+    """
+    Parse command line arguments.
+    """
+    global _PARSER
+    if _PARSER is None:
+        _PARSER = create_parser()
+    return _PARSER.parse_args()
 
 
 @dataclass
 class MqttConnectionConfig:
     ca_certs: str
-    tls_version: int = ssl.PROTOCOL_TLSv1_2
+    tls_version: int = ssl.PROTOCOL_TLS_CLIENT
     mqtt_bridge_hostname: str = "mqtt.googleapis.com"
     mqtt_bridge_port: int = 8883
+    connect_timeout: float = 5
 
 
 @contextmanager
 def managed_device(
         client_id: str,
         conn_cfg: MqttConnectionConfig,
-        token: str = None
+        token: Union[str, Callable[[], str]] = None,
+        wait_for_connection: bool = True
 ):
     device = Device.create_from_client_id(client_id)
     if token:
@@ -330,9 +786,41 @@ def managed_device(
         conn_cfg.mqtt_bridge_port
     )
     device.loop_start()
-    yield device
-    device.disconnect()
-    device.loop_stop()
+    try:
+        if wait_for_connection:
+            device.wait_for_connection(conn_cfg.connect_timeout)
+        yield device
+    finally:
+        device.disconnect()
+        device.loop_stop()
+
+
+@contextmanager
+def managed_fleet(
+        gateway_client_id: str,
+        device_ids: List[str],
+        conn_cfg: MqttConnectionConfig,
+        token: Union[str, Callable[[], str]] = None
+):
+    with managed_device(gateway_client_id, conn_cfg, token) as gateway:
+        # Failed attaches and publishes of attached devices are only
+        # reported on the gateway errors topic.
+        gateway.subscribe(gateway.errors_topic, qos=0)
+        fleet = DeviceFleet(gateway)
+        try:
+            for device_id in device_ids:
+                fleet.attach(device_id)
+            yield fleet
+        finally:
+            detached = [
+                fleet.detach(device.device_id) for device in fleet.devices
+            ]
+            # Give the detach messages a chance to be sent before the
+            # gateway disconnects, without hanging if it is not connected.
+            unpublished = wait_for_publish(detached, conn_cfg.connect_timeout)
+            if unpublished:
+                logger.warning("%d detach messages were not sent.",
+                               unpublished)
 
 
 def main():
@@ -341,52 +829,112 @@ def main():
     if args.verbose:
         logger.setLevel(logging.DEBUG)
 
-    client_id = (f"projects/{args.project_id}/"
-                 f"locations/{args.cloud_region}/"
-                 f"registries/{args.registry_id}/"
-                 f"devices/{args.device_id}")
     conn_cfg = MqttConnectionConfig(
         ca_certs=args.ca_certs,
-        tls_version=ssl.PROTOCOL_TLSv1_2,
+        tls_version=ssl.PROTOCOL_TLS_CLIENT,
         mqtt_bridge_hostname=args.mqtt_bridge_hostname,
-        mqtt_bridge_port=args.mqtt_bridge_port
+        mqtt_bridge_port=args.mqtt_bridge_port,
+        connect_timeout=args.connect_timeout
+    )
+    token = functools.partial(
+        get_jwt,
+        args.project_id,
+        args.private_key_file,
+        args.algorithm
+    )
+    client_id = functools.partial(
+        make_client_id,
+        args.project_id,
+        args.cloud_region,
+        args.registry_id
     )
-    token = create_jwt(args.project_id, args.private_key_file, args.algorithm)
-
-    # This is the topic that the device will publish telemetry events
-    # (e.g. temperature data, power consumption etc.) to.
-    mqtt_telemetry_topic = f"/devices/{args.device_id}/events"
-
-    # This is the topic that the device will receive configuration updates on.
-    mqtt_config_topic = f"/devices/{args.device_id}/config"
-
-    # This is the topic that the device will receive commands from IoT Core.
-    mqtt_commands_topic = f"/devices/{args.device_id}/commands/#"
-
-    with managed_device(client_id, conn_cfg, token) as device:
-        # Subscribe to the config topic.
-        device.subscribe(mqtt_config_topic, qos=1)
 
-        # Subscribe to the commands topic
-        device.subscribe(mqtt_commands_topic, qos=1)
+    with ExitStack() as stack:
+        if args.gateway_id:
+            fleet = stack.enter_context(managed_fleet(
+                client_id(args.gateway_id),
+                args.device_id,
+                conn_cfg,
+                token
+            ))
+            devices = fleet.devices
+        else:
+            devices = [
+                stack.enter_context(managed_device(
+                    client_id(device_id),
+                    conn_cfg,
+                    token,
+                    wait_for_connection=False
+                ))
+                for device_id in args.device_id
+            ]
+            # Let all devices connect concurrently before waiting on them.
+            for device in devices:
+                device.wait_for_connection(conn_cfg.connect_timeout)
+
+        payload_prefixes = []
+        for device in devices:
+            # Subscribe to the config topic.
+            device.subscribe(device.config_topic, qos=1)
+
+            # Subscribe to the commands topic
+            device.subscribe(device.commands_topic, qos=1)
+
+            payload_prefixes.append(
+                f"{device.registry_id}/{device.device_id}-payload-".encode()
+            )
 
         # Update and publish telemetry readings.
-        for i in range(1, args.num_messages + 1):
-            payload = f"{device.registry_id}/{device.device_id}-payload-{i}"
-            logger.info(
-                f"Publishing message '{i}' '{args.num_messages}': '{payload}'"
-            )
-            device.publish(mqtt_telemetry_topic, payload, qos=1)
-            # Send events every second.
-            time.sleep(randint(1, 4))
+        pending = []
+        if args.publish_interval == 0:
+            # Nothing to wait for between messages, hand them all to paho
+            # at once.
+            for device, payload_prefix in zip(devices, payload_prefixes):
+                logger.info(
+                    "Publishing %d messages for %s",
+                    args.num_messages, device.device_id
+                )
+                pending += device.publish_many(
+                    device.telemetry_topic,
+                    [payload_prefix + str(i).encode()
+                     for i in range(1, args.num_messages + 1)],
+                    qos=1
+                )
+        else:
+            # Messages are scheduled against a monotonic deadline, so time
+            # spent publishing does not add up to the delay between messages.
+            next_publish_time = time.monotonic()
+            # Look these up once rather than on every iteration.
+            publishers = [
+                (device.publish, device.telemetry_topic, payload_prefix)
+                for device, payload_prefix in zip(devices, payload_prefixes)
+            ]
+            for i in range(1, args.num_messages + 1):
+                for publish, telemetry_topic, payload_prefix in publishers:
+                    payload = payload_prefix + str(i).encode()
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info(
+                            "Publishing message '%d' '%d': '%s'",
+                            i, args.num_messages, payload.decode()
+                        )
+                    pending.append(publish(telemetry_topic, payload, qos=1))
+                next_publish_time += random.uniform(0, args.publish_interval)
+                delay = next_publish_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+        # paho keeps only a limited number of QoS 1 messages in flight and
+        # queues the rest, which would be lost on disconnect.
+        unpublished = wait_for_publish(pending, conn_cfg.connect_timeout)
+        if unpublished:
+            logger.warning("%d messages were not published.", unpublished)
 
-        # This is the topic that the device will send state updates on.
-        mqtt_state_topic = f"/devices/{device.device_id}/state"
         payload = "Fake state"
-        logger.info(
-            f"Publishing {device.device_id} STATE: '{payload}'"
-        )
-        device.publish(mqtt_state_topic, payload)
+        for device in devices:
+            logger.info(
+                "Publishing %s STATE: '%s'", device.device_id, payload
+            )
+            device.publish(device.state_topic, payload)
 
     logger.info("Finished loop successfully. Goodbye!")
 